@@ -3,10 +3,21 @@
 
 import os
 import math
+import functools
+import operator
 import json
 import requests
+import time
 import urllib.parse
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timezone
+
+try:
+    import orjson  # parse/serializzazione JSON molto più veloci
+except ImportError:
+    orjson = None
 
 # === LOCALITÀ DA MONITORARE (nome, lat, lon) ===
 LOCATIONS = [
@@ -17,60 +28,165 @@ LOCATIONS = [
 # === PARAMETRI COMUNI ===
 RADIUS_KM       = 40.0
 ALT_THRESHOLD_M = 2000.0
+ALT_THRESHOLD_FT = ALT_THRESHOLD_M / 0.3048   # il provider dà la quota in piedi
 QUIET_MINUTES   = 10            # antispam per singolo velivolo/località
 STATE_FILE      = "state.json"
+TELEGRAM_MAX_WORKERS = 4        # invii paralleli verso le chat Telegram
+PHOTO_MAX_WORKERS    = 4        # ricerche foto parallele per gli alert di una località
+PHOTO_CACHE_FILE    = "photo_cache.json"
+PHOTO_CACHE_TTL     = 30 * 86400    # le foto di un velivolo cambiano di rado
+PHOTO_CACHE_NEG_TTL = 1 * 86400     # "nessuna foto" si riverifica prima
+PHOTO_MAX_BYTES     = 5 * 1024 * 1024   # limite per il download di fallback della foto
 
 # Endpoint gratuiti compatibili con ADS-B Exchange v2
 PROVIDERS = [
     "https://api.adsb.one",
     "https://api.adsb.lol",
 ]
+# Template URL per provider, calcolati una volta sola
+PROVIDER_URLS = {base: base + "/v2/point/{lat:.6f}/{lon:.6f}/{range_nm}" for base in PROVIDERS}
+PROVIDER_COOLDOWN_S = 600       # un provider in errore viene saltato per 10 minuti (il run successivo)
+PROVIDER_HEALTH_FILE = "provider_health.json"
+UNION_MAX_KM        = 460.0     # raggio massimo di /v2/point (250 NM) per la query unica
+
+# Riga fissa del riepilogo (dipende solo dalle costanti sopra)
+SUMMARY_LIMITS_LINE = f"Raggio: {RADIUS_KM:.0f} km • Soglia: < {int(ALT_THRESHOLD_M)} m"
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID   = os.environ.get("TELEGRAM_CHAT_ID")  # opzionale
 # Facoltativo: lista chat extra separata da virgole (es. "123,456,789")
 TELEGRAM_EXTRA_CHAT_IDS = os.environ.get("TELEGRAM_EXTRA_CHAT_IDS", "")
 
+# Sessione HTTP condivisa: connection pooling + keep-alive (un solo handshake TLS per host)
+SESSION = requests.Session()
+# Retry solo sugli errori nell'aprire una connessione nuova (richiesta mai partita):
+# niente doppi invii Telegram e nessun nuovo tentativo dopo un timeout di lettura.
+# Un socket keep-alive chiuso dal server a metà richiesta per urllib3 è un errore
+# di lettura: con read=0 non viene ritentato e la chiamata fallisce.
+_adapter = HTTPAdapter(
+    pool_connections=8, pool_maxsize=16,
+    max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.3),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"User-Agent": "ADSBbot/1.0"})
+
 # ----------------- UTIL -----------------
 def km_to_nm(km): return km * 0.539956803
 def feet_to_m(ft): return ft * 0.3048
 
-def haversine_km(lat1, lon1, lat2, lon2):
-    R = 6371.0088
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-    return 2 * R * math.asin(math.sqrt(a))
-
-def load_state():
-    if not os.path.exists(STATE_FILE): 
+# Raggio standard in NM per i provider, calcolato una volta sola
+RANGE_NM = max(1, int(round(km_to_nm(RADIUS_KM))))
+
+def num(x):
+    # x se è un numero JSON (int/float), altrimenti None; type() esclude anche i bool
+    return x if type(x) is float or type(x) is int else None
+
+def json_loads(data):
+    # accetta bytes (es. resp.content) o str
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj):
+    # ritorna sempre bytes UTF-8
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def write_atomic(path, data):
+    # scrive su file temporaneo e poi rinomina: un crash a metà non lascia il file vuoto
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_json_dict(path, label):
+    # dict JSON dal file; {} se manca, errore segnalato se illeggibile/corrotto
+    try:
+        with open(path, "rb") as f:
+            raw = json_loads(f.read())
+    except FileNotFoundError:
         return {}
+    except (OSError, ValueError) as e:
+        print(f"Load {label} error:", e)
+        return {}
+    if not isinstance(raw, dict):
+        print(f"Load {label} error: formato inatteso")
+        return {}
+    return raw
+
+def aircraft_ident(ac):
+    """
+    (callsign, reg, icao) già ripuliti: calcolati alla prima richiesta e
+    memorizzati sul dict del velivolo in ac["_ident"], poi solo letti.
+    """
+    ident = ac.get("_ident")
+    if ident is None:
+        ident = ac["_ident"] = (
+            (ac.get("call") or ac.get("flight") or "").strip(),
+            (ac.get("r") or "").strip(),
+            (ac.get("icao") or ac.get("hex") or "").strip(),
+        )
+    return ident
+
+def _legacy_ts(v):
+    # voci scritte dalle versioni precedenti come stringhe ISO
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-        out = {}
+        return datetime.fromisoformat(v).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def load_state():
+    # {"località:chiave": epoch (float)}
+    raw = read_json_dict(STATE_FILE, "state")
+    out = {k: float(v) for k, v in raw.items() if isinstance(v, (int, float))}
+    if len(out) < len(raw):
         for k, v in raw.items():
-            try:
-                out[k] = datetime.fromisoformat(v)
-            except Exception:
-                pass
-        return out
-    except Exception:
-        return {}
+            if isinstance(v, str):
+                ts = _legacy_ts(v)
+                if ts is not None:
+                    out[k] = ts
+    return out
 
 def save_state(state):
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({k: v.isoformat() for k, v in state.items()}, f, ensure_ascii=False)
+        write_atomic(STATE_FILE, json_dumps(state))
     except Exception as e:
         print("Save state error:", e)
 
 # ---------- Foto aereo (Planespotters) ---------------------------------------
+def load_photo_cache():
+    raw = read_json_dict(PHOTO_CACHE_FILE, "photo cache")
+    return {k: v for k, v in raw.items() if isinstance(v, dict)}
+
+def _photo_entry_alive(entry, now):
+    if not entry.get("url"):
+        return now - entry.get("ts", 0) < PHOTO_CACHE_NEG_TTL
+    # con ETag/Last-Modified la voce scaduta serve ancora per il GET condizionale:
+    # la si tiene un altro PHOTO_CACHE_TTL, poi si scarta comunque
+    keep = PHOTO_CACHE_TTL * 2 if entry.get("etag") or entry.get("last_modified") else PHOTO_CACHE_TTL
+    return now - entry.get("ts", 0) < keep
+
+def save_photo_cache():
+    # le voci scadute non vengono più salvate: il file (committato a ogni run) resta piccolo
+    now = time.time()
+    fresh = {k: v for k, v in PHOTO_CACHE.items() if _photo_entry_alive(v, now)}
+    try:
+        write_atomic(PHOTO_CACHE_FILE, json_dumps(fresh))
+    except Exception as e:
+        print("Save photo cache error:", e)
+
+# {"REG|hex": {"url": str | None, "ts": epoch}} — anche gli esiti negativi
+PHOTO_CACHE = load_photo_cache()
+
 def get_aircraft_photo(reg=None, icao=None):
     """
     Ritorna un URL immagine (stringa) se disponibile.
     Prova prima per matricola (reg), poi per esadecimale (icao/hex).
     Gestisce sia stringhe dirette che eventuali dizionari (retro-compat).
+    Gli esiti (anche "nessuna foto") restano in PHOTO_CACHE per PHOTO_CACHE_TTL;
+    alla scadenza una foto nota si riconvalida con ETag/Last-Modified (304 = invariata).
     """
     def _first_url_from_photo_obj(p):
         # preferisci thumbnail_large, poi thumbnail, poi image (se presente)
@@ -90,33 +206,86 @@ def get_aircraft_photo(reg=None, icao=None):
     reg = (reg or "").strip().upper()
     icao = (icao or "").strip().lower()
 
+    if not reg and not icao:
+        return None
+
+    cache_key = f"{reg}|{icao}"
+    now = time.time()
+    cached = PHOTO_CACHE.get(cache_key)
+    if cached:
+        ttl = PHOTO_CACHE_TTL if cached.get("url") else PHOTO_CACHE_NEG_TTL
+        if now - cached.get("ts", 0) < ttl:
+            return cached.get("url")
+
     if reg:
         endpoints.append(f"https://api.planespotters.net/pub/photos/reg/{reg}")
     if icao:
         endpoints.append(f"https://api.planespotters.net/pub/photos/hex/{icao}")
+    # L'endpoint che aveva dato la foto va riconvalidato per primo
+    if cached and cached.get("url") and cached.get("endpoint") in endpoints:
+        endpoints.remove(cached["endpoint"])
+        endpoints.insert(0, cached["endpoint"])
 
+    failed = False
     for url in endpoints:
+        req_headers = headers
+        if cached and cached.get("url") and cached.get("endpoint") == url:
+            # GET condizionale sull'endpoint che aveva dato la foto
+            req_headers = dict(headers)
+            if cached.get("etag"):
+                req_headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                req_headers["If-Modified-Since"] = cached["last_modified"]
         try:
-            r = requests.get(url, headers=headers, timeout=10)
+            # L'API di Planespotters non fa redirect: niente hop inutili
+            r = SESSION.get(url, headers=req_headers, timeout=10, allow_redirects=False)
+            if r.status_code == 304 and req_headers is not headers:
+                PHOTO_CACHE[cache_key] = dict(cached, ts=now)
+                return cached["url"]
             if r.status_code != 200:
+                failed = failed or r.status_code != 404
+                continue
+            # Corpo vuoto o '{"photos":[]}': inutile fare il parse JSON
+            size = r.headers.get("Content-Length")
+            if (int(size) if size and size.isdigit() else len(r.content)) <= 20:
                 continue
-            data = r.json()
+            data = json_loads(r.content)
             photos = data.get("photos") or []
             if not photos:
                 continue
             photo_url = _first_url_from_photo_obj(photos[0])
             if photo_url:
                 # print("[PHOTO]", url, "->", photo_url)  # debug facoltativo
+                entry = {"url": photo_url, "ts": now, "endpoint": url}
+                if r.headers.get("ETag"):
+                    entry["etag"] = r.headers["ETag"]
+                if r.headers.get("Last-Modified"):
+                    entry["last_modified"] = r.headers["Last-Modified"]
+                PHOTO_CACHE[cache_key] = entry
                 return photo_url
         except Exception as e:
+            failed = True
             print("Photo lookup error:", e)
 
+    # Memorizza il "nessuna foto" solo se Planespotters ha risposto davvero
+    if not failed:
+        PHOTO_CACHE[cache_key] = {"url": None, "ts": now}
     return None
 
 # ---------- FR24 links (app-first con fallback) ------------------------------
+@functools.lru_cache(maxsize=512)
+def _intent(path, https_url):
+    # stesso velivolo => stesso intent: il percent-encoding si fa una volta sola
+    return (
+        "intent://www.flightradar24.com/" + path +
+        "#Intent;scheme=https;package=com.flightradar24free;" +
+        "S.browser_fallback_url=" + urllib.parse.quote(https_url, safe="") + ";end"
+    )
+
 def fr24_links(ac, lat=None, lon=None):
-    call = (ac.get("call") or ac.get("flight") or "").strip().replace(" ", "")
-    reg  = (ac.get("r") or "").strip().replace(" ", "")
+    call, reg, _ = aircraft_ident(ac)
+    call = call.replace(" ", "")
+    reg  = reg.replace(" ", "")
     if call:
         path = call
     elif reg:
@@ -127,16 +296,12 @@ def fr24_links(ac, lat=None, lon=None):
         path = ""
 
     https = f"https://www.flightradar24.com/{path}"
-    intent = (
-        "intent://www.flightradar24.com/" + path +
-        "#Intent;scheme=https;package=com.flightradar24free;" +
-        "S.browser_fallback_url=" + urllib.parse.quote(https, safe="") + ";end"
-    )
+    intent = _intent(path, https)
     ios_scheme = "fr24://"   # apre l'app FR24 su iOS (se il client lo consente)
     return {"https": https, "android_intent": intent, "ios_scheme": ios_scheme}
 
 def adsbx_url(ac):
-    hx = (ac.get("icao") or ac.get("hex") or "").strip().lower()
+    hx = aircraft_ident(ac)[2].lower()
     return f"https://globe.adsbexchange.com/?icao={hx}" if hx else "https://globe.adsbexchange.com/"
 
 def build_links_text(ac, lat=None, lon=None):
@@ -166,133 +331,227 @@ def _telegram_recipients():
     extra = [x.strip() for x in TELEGRAM_EXTRA_CHAT_IDS.split(",") if x.strip()]
     chat_ids.extend(extra)
     # dedup preservando ordine
-    seen = set()
-    out = []
-    for cid in chat_ids:
-        if cid not in seen:
-            out.append(cid)
-            seen.add(cid)
-    return out
+    return list(dict.fromkeys(chat_ids))
 
-def send_telegram(text, photo_url=None, extra_text=None):
+def _download_photo(photo_url):
     """
+    Scarica l'immagine in streaming (chunk da 64 KB) fermandosi oltre PHOTO_MAX_BYTES.
+    Ritorna i bytes, oppure None se non disponibile o troppo grande.
+    """
+    with SESSION.get(photo_url, stream=True, timeout=20) as img:
+        if img.status_code != 200:
+            return None
+        size = img.headers.get("Content-Length")
+        if size and size.isdigit() and int(size) > PHOTO_MAX_BYTES:
+            return None
+        chunks = []
+        total = 0
+        for chunk in img.iter_content(64 * 1024):
+            total += len(chunk)
+            if total > PHOTO_MAX_BYTES:
+                return None
+            chunks.append(chunk)
+    return b"".join(chunks) or None
+
+def _send_to_chat(base_url, cid, text, caption, photo_url=None, extra_text=None, preview=False):
+    try:
+        if photo_url:
+            # 1) tenta invio per URL (più leggero)
+            r = SESSION.post(
+                f"{base_url}/sendPhoto",
+                json={"chat_id": cid, "caption": caption, "photo": photo_url},
+                timeout=20
+            )
+            ok = False
+            try:
+                ok = r.status_code == 200 and r.json().get("ok", False)
+            except Exception:
+                ok = (r.status_code == 200)
+
+            if not ok:
+                # 2) fallback: scarica e ricarica come file
+                content = _download_photo(photo_url)
+                if content:
+                    files = {"photo": ("aircraft.jpg", content)}
+                    data = {"chat_id": cid, "caption": caption}
+                    r2 = SESSION.post(f"{base_url}/sendPhoto", data=data, files=files, timeout=30)
+                    r2.raise_for_status()
+                else:
+                    # 3) se pure il download fallisce, mando almeno il testo con link della foto
+                    fallback_text = f"{text}\n\n(Foto): {photo_url}"
+                    r3 = SESSION.post(
+                        f"{base_url}/sendMessage",
+                        json={"chat_id": cid, "text": fallback_text, "disable_web_page_preview": False},
+                        timeout=20
+                    )
+                    r3.raise_for_status()
+        else:
+            r = SESSION.post(
+                f"{base_url}/sendMessage",
+                json={"chat_id": cid, "text": text, "disable_web_page_preview": not preview},
+                timeout=20
+            )
+            r.raise_for_status()
+
+        # Secondo messaggio con i link solo se non stavano nella caption
+        if extra_text:
+            rL = SESSION.post(
+                f"{base_url}/sendMessage",
+                json={"chat_id": cid, "text": extra_text, "disable_web_page_preview": False},
+                timeout=20
+            )
+            rL.raise_for_status()
+
+    except Exception as e:
+        print(f"Telegram error for chat {cid}:", e)
+
+def _prepare_message(text, photo_url=None, extra_text=None):
+    # -> (text, caption, photo_url, extra, preview) pronti per _send_to_chat
+    extra = extra_text if extra_text and extra_text.strip() else None
+    preview = False
+    if extra:
+        full_text = f"{text}\n\n{extra}"
+        if not photo_url or len(full_text) <= 1024:
+            # i link accodati mantengono l'anteprima che avevano nel messaggio separato
+            text, extra, preview = full_text, None, True
+    return text, _truncate_caption(text), photo_url, extra, preview
+
+def send_telegram_many(messages):
+    """
+    'messages' è una lista di (text, photo_url, extra_text), in ordine di invio.
     Se c'è 'photo_url' prova prima a inviare per URL.
     Se fallisce, scarica l'immagine e la ricarica come file (fallback).
-    Dopo la foto (o il testo), se 'extra_text' è valorizzato, invia un secondo
-    messaggio di testo (utile per link lunghi come intent://, fr24://, ecc.).
+    'extra_text' (link intent://, fr24://, ecc.) viene accodato al testo così da
+    fare una sola chiamata per chat; va in un secondo messaggio solo se con la
+    foto si supererebbe il limite di 1024 caratteri della caption.
+    Le chat sono servite in parallelo; ogni chat riceve i messaggi nell'ordine dato.
     """
     if not TELEGRAM_BOT_TOKEN:
         print("Telegram not configured: TELEGRAM_BOT_TOKEN assente.")
         return
+    if not messages:
+        return
 
     base_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
     chat_ids = _telegram_recipients()
-    caption = _truncate_caption(text)
+    prepared = [_prepare_message(*m) for m in messages]
 
-    for cid in chat_ids:
-        try:
-            if photo_url:
-                # 1) tenta invio per URL (più leggero)
-                r = requests.post(
-                    f"{base_url}/sendPhoto",
-                    json={"chat_id": cid, "caption": caption, "photo": photo_url},
-                    timeout=20
-                )
-                ok = False
-                try:
-                    ok = r.status_code == 200 and r.json().get("ok", False)
-                except Exception:
-                    ok = (r.status_code == 200)
-
-                if not ok:
-                    # 2) fallback: scarica e ricarica come file
-                    img = requests.get(photo_url, timeout=20)
-                    if img.status_code == 200 and img.content:
-                        files = {"photo": ("aircraft.jpg", img.content)}
-                        data = {"chat_id": cid, "caption": caption}
-                        r2 = requests.post(f"{base_url}/sendPhoto", data=data, files=files, timeout=30)
-                        r2.raise_for_status()
-                    else:
-                        # 3) se pure il download fallisce, mando almeno il testo con link della foto
-                        fallback_text = f"{text}\n\n(Foto): {photo_url}"
-                        r3 = requests.post(
-                            f"{base_url}/sendMessage",
-                            json={"chat_id": cid, "text": fallback_text, "disable_web_page_preview": False},
-                            timeout=20
-                        )
-                        r3.raise_for_status()
-            else:
-                r = requests.post(
-                    f"{base_url}/sendMessage",
-                    json={"chat_id": cid, "text": text, "disable_web_page_preview": True},
-                    timeout=20
-                )
-                r.raise_for_status()
-
-            # Eventuale secondo messaggio con i link (deep link app + web)
-            if extra_text and extra_text.strip():
-                rL = requests.post(
-                    f"{base_url}/sendMessage",
-                    json={"chat_id": cid, "text": extra_text, "disable_web_page_preview": False},
-                    timeout=20
-                )
-                rL.raise_for_status()
+    def _send_all(cid):
+        for text, caption, photo_url, extra, preview in prepared:
+            _send_to_chat(base_url, cid, text, caption, photo_url, extra, preview)
 
-        except Exception as e:
-            print(f"Telegram error for chat {cid}:", e)
+    with ThreadPoolExecutor(max_workers=min(TELEGRAM_MAX_WORKERS, len(chat_ids))) as ex:
+        futures = [ex.submit(_send_all, cid) for cid in chat_ids]
+        for fut in futures:
+            fut.result()
+
+def send_telegram(text, photo_url=None, extra_text=None):
+    send_telegram_many([(text, photo_url, extra_text)])
 
 # ---------------------------------------------------------------------------
-def fetch_aircraft(lat, lon, radius_km):
-    range_nm = max(1, int(round(km_to_nm(radius_km))))
+def load_provider_failures():
+    raw = read_json_dict(PROVIDER_HEALTH_FILE, "provider health")
+    return {k: float(v) for k, v in raw.items() if isinstance(v, (int, float))}
+
+def save_provider_failures():
+    # solo gli errori ancora in cooldown
+    now = time.time()
+    recent = {k: ts for k, ts in _provider_failures.items() if now - ts < PROVIDER_COOLDOWN_S}
+    try:
+        write_atomic(PROVIDER_HEALTH_FILE, json_dumps(recent))
+    except Exception as e:
+        print("Save provider health error:", e)
+
+# base provider -> time.time() dell'ultimo errore; su disco perché ogni run
+# del workflow è un processo nuovo
+_provider_failures = load_provider_failures()
+# richieste dei provider battuti sul tempo, ancora in volo a fine gara
+_provider_pending = []
+
+def _fetch_provider(base, lat, lon, range_nm):
+    # l'esito si registra qui, nel worker: vale anche per chi perde la gara
+    try:
+        url = PROVIDER_URLS[base].format(lat=lat, lon=lon, range_nm=range_nm)
+        resp = SESSION.get(url, timeout=30)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{base}: HTTP {resp.status_code}")
+        data = json_loads(resp.content)
+    except Exception:
+        _provider_failures[base] = time.time()
+        raise
+    _provider_failures.pop(base, None)
+    return data.get("ac", []) or []
+
+def _race_providers(candidates, lat, lon, range_nm):
+    # prima risposta valida tra 'candidates'; se falliscono tutti solleva l'ultimo errore
     last_exc = None
+    futures = []
+    ex = ThreadPoolExecutor(max_workers=len(candidates))
+    try:
+        futures = [ex.submit(_fetch_provider, base, lat, lon, range_nm) for base in candidates]
+        for fut in as_completed(futures):
+            try:
+                return fut.result()
+            except Exception as e:
+                last_exc = e
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+        # i più lenti finiscono in background; main() li attende prima di
+        # salvare provider_health.json, così un errore entra nel cooldown.
+        # Dopo lo shutdown: le richieste annullate risultano già done()
+        _provider_pending.extend(f for f in futures if not f.done())
+    raise last_exc
+
+def fetch_aircraft(lat, lon, radius_km=RADIUS_KM):
+    """
+    Interroga in parallelo i provider "sani" e ritorna la prima risposta valida.
+    Se falliscono tutti, prova anche quelli in cooldown prima di arrendersi.
+    """
+    if radius_km == RADIUS_KM:
+        range_nm = RANGE_NM
+    else:
+        # arrotonda per eccesso: la query non deve mai coprire meno del richiesto
+        range_nm = max(1, math.ceil(km_to_nm(radius_km)))
+    now = time.time()
+    healthy, cooling = [], []
     for base in PROVIDERS:
-        url = f"{base}/v2/point/{lat:.6f}/{lon:.6f}/{range_nm}"
+        if now - _provider_failures.get(base, 0) > PROVIDER_COOLDOWN_S:
+            healthy.append(base)
+        else:
+            cooling.append(base)
+    last_exc = None
+    for candidates in (healthy, cooling):
+        if not candidates:
+            continue
         try:
-            resp = requests.get(url, timeout=30)
-            if resp.status_code == 200:
-                data = resp.json()
-                return data.get("ac", []) or []
+            return _race_providers(candidates, lat, lon, range_nm)
         except Exception as e:
             last_exc = e
-            continue
-    if last_exc:
-        raise last_exc
-    return []
-
-def get_altitude_m(ac):
-    alt_ft = None
-    if isinstance(ac.get("alt_baro"), (int, float)): 
-        alt_ft = ac["alt_baro"]
-    elif isinstance(ac.get("alt_geom"), (int, float)): 
-        alt_ft = ac["alt_geom"]
-    return None if alt_ft is None else feet_to_m(alt_ft)
+    raise last_exc
 
 def identify(ac):
-    callsign = (ac.get("call") or ac.get("flight") or "").strip()
-    reg = (ac.get("r") or "").strip()
-    icao = (ac.get("icao") or ac.get("hex") or "").strip()
+    callsign, reg, icao = aircraft_ident(ac)
     label = callsign or (reg and f"({reg})") or icao or "Sconosciuto"
     key = (icao or callsign or reg or "unknown").upper()
     return label, key
 
-def format_msg_and_photo(ac, dist_km, alt_m, place):
-    callsign = (ac.get("call") or ac.get("flight") or "").strip()
-    reg = (ac.get("r") or "").strip()
-    icao = (ac.get("icao") or ac.get("hex") or "").strip()
+def format_msg_and_photo(ac, dist_km, alt_m, header):
+    callsign, reg, icao = aircraft_ident(ac)
     typ = ac.get("t") or ac.get("type") or ""
-    spd = ac.get("gs") or ac.get("spd")
-    hdg = ac.get("trak") or ac.get("hdg")
+    spd = num(ac.get("gs") or ac.get("spd"))
+    hdg = num(ac.get("trak") or ac.get("hdg"))
     lat = ac.get("lat"); lon = ac.get("lon")
 
-    # Messaggio "corto" senza i link (che invieremo a parte per aprire l'app)
+    # Messaggio "corto" senza i link (li accoda send_telegram)
+    # 'header' è precalcolato una volta per località in run_once_for
     lines = [
-        f"✈️ Velivolo a bassa quota — {place}",
+        header,
         f"{(callsign + ' ').strip()}{f'({reg})' if reg else ''}".strip() or (icao or "ICAO?"),
         f"Tipo: {typ}" if typ else None,
         f"Distanza: {dist_km:.1f} km",
         f"Quota: {int(round(alt_m))} m" if alt_m is not None else "Quota: n/d",
-        f"Velocità: {int(round(spd))} kt" if isinstance(spd, (int, float)) else None,
-        f"Prua: {int(round(hdg))}°" if isinstance(hdg, (int, float)) else None,
+        f"Velocità: {int(round(spd))} kt" if spd is not None else None,
+        f"Prua: {int(round(hdg))}°" if hdg is not None else None,
     ]
     msg = "\n".join([x for x in lines if x])
 
@@ -303,48 +562,117 @@ def format_msg_and_photo(ac, dist_km, alt_m, place):
     photo_url = get_aircraft_photo(reg=reg, icao=icao)
     return msg, links_text, photo_url
 
-def run_once_for(place, center_lat, center_lon):
-    state = load_state()
-    quiet = timedelta(minutes=QUIET_MINUTES)
-    now = datetime.now(timezone.utc)
-
-    try:
-        aircraft = fetch_aircraft(center_lat, center_lon, RADIUS_KM)
-    except Exception as e:
-        print(f"Fetch error ({place}):", e)
-        return
-
-    # 1) Filtra tutti i velivoli che rispettano raggio/altitudine
+def _filter_fast(aircraft, center_lat, center_lon, kx, ky, r2):
+    """
+    Ritorna [(dist_km, alt_m, ac)] dei velivoli sotto soglia entro il raggio.
+    kx/ky (km per grado, cheap ruler) e r2 (raggio al quadrato) arrivano già calcolati.
+    """
     eligible = []
+    # Nomi risolti una volta: nel ciclo diventano accessi a variabili locali
+    append, sqrt, thr_ft = eligible.append, math.sqrt, ALT_THRESHOLD_FT
+    # Riquadro lat/lon che contiene il cerchio: scarto con 4 confronti, senza conti
+    r = sqrt(r2)
+    lat_min, lat_max = center_lat - r / ky, center_lat + r / ky
+    lon_min, lon_max = center_lon - r / kx, center_lon + r / kx
     for ac in aircraft:
+        # Prima la quota: lo scarto più frequente è il traffico in quota
+        # (il provider filtra già per distanza), così niente lat/lon né conti.
+        # Confronto in piedi: la conversione in metri solo per chi passa il filtro.
+        # (controlli di tipo inline come in num(): qui ogni chiamata pesa)
+        alt_ft = ac.get("alt_baro")
+        t = type(alt_ft)
+        if t is not float and t is not int:         # es. "ground"
+            alt_ft = ac.get("alt_geom")
+            t = type(alt_ft)
+            if t is not float and t is not int:
+                continue
+        if alt_ft >= thr_ft:
+            continue
         lat, lon = ac.get("lat"), ac.get("lon")
         if lat is None or lon is None:
             continue
-        dist_km = haversine_km(center_lat, center_lon, lat, lon)
-        if dist_km > RADIUS_KM + 0.5:
+        if lat < lat_min or lat > lat_max or lon < lon_min or lon > lon_max:
             continue
-        alt_m = get_altitude_m(ac)
-        if alt_m is None or alt_m >= ALT_THRESHOLD_M:
+        dx = (lon - center_lon) * kx
+        dy = (lat - center_lat) * ky
+        d2 = dx*dx + dy*dy
+        if d2 > r2:
             continue
-        eligible.append((dist_km, alt_m, ac))
+        append((sqrt(d2), feet_to_m(alt_ft), ac))
+    return eligible
+
+def union_query(locations):
+    """
+    Centro (media delle località) e raggio in km di un'unica query
+    /v2/point che copre i cerchi di tutte le località, inclusi gli 0.5 km
+    di tolleranza del filtro e un 1% di margine per l'errore del cheap ruler.
+    """
+    clat = sum(loc[1] for loc in locations) / len(locations)
+    clon = sum(loc[2] for loc in locations) / len(locations)
+    kx = 111.320 * math.cos(math.radians(clat))
+    ky = 110.574
+    reach = max(math.hypot((lat - clat) * ky, (lon - clon) * kx) for _, lat, lon in locations)
+    return clat, clon, reach * 1.01 + RADIUS_KM + 0.5
+
+def run_once_for(place, center_lat, center_lon, state, aircraft=None):
+    """
+    'aircraft' può arrivare già scaricato (query unica per tutte le località);
+    se manca, la località fa la sua richiesta al provider.
+    """
+    quiet_s = QUIET_MINUTES * 60
+    now = datetime.now(timezone.utc)
+    now_ts = now.timestamp()
+
+    if aircraft is None:
+        try:
+            aircraft = fetch_aircraft(center_lat, center_lon)
+        except Exception as e:
+            print(f"Fetch error ({place}):", e)
+            return
+
+    # 1) Filtra tutti i velivoli che rispettano raggio/altitudine
+    # Entro ~40 km la Terra è "piatta": approssimazione equirettangolare (cheap ruler),
+    # un solo coseno per località e nessuna funzione trigonometrica per velivolo.
+    kx = 111.320 * math.cos(math.radians(center_lat))  # km per grado di longitudine
+    ky = 110.574                                       # km per grado di latitudine
+    r2 = (RADIUS_KM + 0.5) ** 2                        # confronto sul quadrato: niente sqrt sugli scarti
+    eligible = _filter_fast(aircraft, center_lat, center_lon, kx, ky, r2)
 
-    # Ordina per distanza (più vicini prima)
-    eligible.sort(key=lambda x: x[0])
+    # Ordina per distanza (più vicini prima); itemgetter è in C, e una chiave
+    # serve comunque: a pari distanza/quota si confronterebbero i dict
+    eligible.sort(key=operator.itemgetter(0))
 
     # 2) Invia alert individuali solo per i "nuovi" (fuori quiet)
+    alert_hdr = f"✈️ Velivolo a bassa quota — {place}"
     alerted = 0
+    to_alert = []
     for dist_km, alt_m, ac in eligible:
         _, key = identify(ac)
         scoped_key = f"{place}:{key}"  # antispam separato per località
         last = state.get(scoped_key)
-        if last and (now - last) < quiet:
+        if last and (now_ts - last) < quiet_s:
             continue
-        msg, links_text, photo_url = format_msg_and_photo(ac, dist_km, alt_m, place)
+        to_alert.append((scoped_key, dist_km, alt_m, ac))
+
+    # Le ricerche foto (Planespotters) partono in parallelo; gli invii restano
+    # in ordine di distanza così i messaggi arrivano dal più vicino.
+    prepared = []
+    if to_alert:
+        with ThreadPoolExecutor(max_workers=min(PHOTO_MAX_WORKERS, len(to_alert))) as ex:
+            prepared = list(ex.map(
+                lambda a: format_msg_and_photo(a[3], a[1], a[2], alert_hdr), to_alert
+            ))
+
+    # Tutti gli alert della località in un solo giro: le chat procedono in
+    # parallelo senza attendersi a vicenda dopo ogni velivolo.
+    if prepared:
         try:
-            # Invia foto (o testo) + secondo messaggio con i link (deep link app)
-            send_telegram(msg, photo_url=photo_url, extra_text=links_text)
-            state[scoped_key] = now
-            alerted += 1
+            send_telegram_many([
+                (msg, photo_url, links_text) for msg, links_text, photo_url in prepared
+            ])
+            for scoped_key, _, _, _ in to_alert:
+                state[scoped_key] = now_ts
+            alerted = len(to_alert)
         except Exception as e:
             print(f"Telegram error ({place}):", e)
 
@@ -353,7 +681,7 @@ def run_once_for(place, center_lat, center_lon):
         nearest_dist, nearest_alt, nearest_ac = eligible[0]
         lines = [
             f"✈️ {len(eligible)} velivolo/i a bassa quota — {place}",
-            f"Raggio: {RADIUS_KM:.0f} km • Soglia: < {int(ALT_THRESHOLD_M)} m",
+            SUMMARY_LIMITS_LINE,
         ]
         for dist_km, alt_m, ac in eligible[:6]:
             lab, _ = identify(ac)
@@ -365,8 +693,7 @@ def run_once_for(place, center_lat, center_lon):
         links_text = build_links_text(nearest_ac, lat, lon)
 
         # Prova a mettere la foto del più vicino
-        nearest_reg = nearest_ac.get("r") or ""
-        nearest_hex = (nearest_ac.get("icao") or nearest_ac.get("hex") or "")
+        _, nearest_reg, nearest_hex = aircraft_ident(nearest_ac)
         photo_url = get_aircraft_photo(reg=nearest_reg, icao=nearest_hex)
 
         try:
@@ -374,16 +701,43 @@ def run_once_for(place, center_lat, center_lon):
         except Exception as e:
             print(f"Telegram summary error ({place}):", e)
 
-    save_state(state)
     print(f"[{place}] {now.isoformat()} — eligible: {len(eligible)} — alerts sent: {alerted}")
 
+def _run_location(name, lat, lon, state, aircraft=None):
+    print(f"--- Controllo {name} ---")
+    try:
+        run_once_for(name, lat, lon, state, aircraft)
+    except Exception as e:
+        print(f"Errore per {name}: {e}")
+
 def main():
-    for name, lat, lon in LOCATIONS:
-        print(f"--- Controllo {name} ---")
-        try:
-            run_once_for(name, lat, lon)
-        except Exception as e:
-            print(f"Errore per {name}: {e}")
+    if not LOCATIONS:
+        return
+    # Stato caricato/salvato una sola volta: le chiavi sono per località,
+    # quindi i thread aggiornano voci distinte dello stesso dict.
+    state = load_state()
+
+    # Più località: una sola richiesta al provider che le copre tutte,
+    # poi ogni località filtra in locale (se fallisce, fetch per località).
+    aircraft = None
+    if len(LOCATIONS) > 1:
+        clat, clon, radius_km = union_query(LOCATIONS)
+        if radius_km <= UNION_MAX_KM:
+            try:
+                aircraft = fetch_aircraft(clat, clon, radius_km)
+            except Exception as e:
+                print("Fetch error (query unica):", e)
+
+    with ThreadPoolExecutor(max_workers=len(LOCATIONS)) as ex:
+        list(ex.map(lambda loc: _run_location(*loc, state, aircraft), LOCATIONS))
+    # Voci più vecchie della finestra antispam: non servono più, il file resta piccolo
+    cutoff = time.time() - QUIET_MINUTES * 60
+    save_state({k: ts for k, ts in state.items() if ts >= cutoff})
+    save_photo_cache()
+    # attesa limitata dal timeout delle richieste; all'uscita l'interprete
+    # aspetterebbe comunque questi thread
+    wait(_provider_pending)
+    save_provider_failures()
 
 if __name__ == "__main__":
     main()